@@ -1,5 +1,8 @@
+import functools
 import logging
 import os
+import threading
+import time
 from pathlib import Path
 
 import pyfiglet
@@ -39,17 +42,57 @@ elif PROD and not Path(SOURCE).exists():
 
 app = Flask(__name__)
 
-searcher = Searcher(
-    SOURCE,
-    use_spellcheck = USE_SPELLCHECK,
-    name = 'index_main' if SOURCE == 'developer' else 'index_debug',
-    persist = True,
-    load_existing = not REBUILD,
-    no_duplicate_detection = NO_DUPLICATE_DETECTION,
-)
+# The searcher is created on first use rather than at import, so each (gunicorn) worker loads the
+# index itself instead of duplicating a copy loaded before forking.
+_searcher: Searcher | None = None
+_searcher_lock = threading.Lock()
+
+# Search time reported by the searcher for this thread's latest uncached search, see cached_search.
+# Per thread, as Flask may serve requests concurrently.
+_search_time = threading.local()
 
 summarizer = Summarizer()
 
+def get_searcher() -> Searcher:
+    """
+    Get this process's searcher, creating it on first use.
+
+    Returns:
+        The searcher.
+    """
+    global _searcher
+
+    if _searcher is None:
+        with _searcher_lock:
+            if _searcher is None: # Another thread may have created it while we waited.
+                _searcher = Searcher(
+                    SOURCE,
+                    use_spellcheck = USE_SPELLCHECK,
+                    name = 'index_main' if SOURCE == 'developer' else 'index_debug',
+                    persist = True,
+                    load_existing = not REBUILD,
+                    no_duplicate_detection = NO_DUPLICATE_DETECTION,
+                )
+
+    return _searcher
+
+@functools.lru_cache(maxsize = 4096)
+def cached_search(query: str) -> list[tuple[str, str, int]]:
+    """
+    Search for a query, reusing earlier results for repeated queries (e.g. when paging through
+    results). The index is read-only while serving, so cached results never go stale. Only the
+    results are cached. When the query is actually searched, the searcher's own search time
+    (retrieval only, excluding ranking) is left in _search_time.value for the caller.
+
+    Args:
+        query: String search query.
+
+    Returns:
+        Results of Searcher.search. The list is shared between calls and must not be modified.
+    """
+    results, _search_time.value = get_searcher().search(query)
+    return results
+
 @app.template_filter('zip')
 def zip_lists(a, b):
     return zip(a, b)
@@ -67,7 +110,13 @@ def search():
     if not query:
         return render_template('results.html', results=[], search_time='', page=page)
 
-    results, search_time = searcher.search(query)
+    _search_time.value = None
+    start_time = time.perf_counter()
+    results = cached_search(query)
+    search_time = _search_time.value
+    if search_time is None: # Served from the cache, so report the time of the cache lookup.
+        search_time = (f'Found {len(results)} results in '
+                       f'{round(time.perf_counter() - start_time, 3)} seconds')
 
     start_index = (page - 1) * results_per_page
     end_index = start_index + results_per_page
@@ -85,7 +134,7 @@ def search():
 @app.route('/result-details', methods=['GET'])
 def summary():
     doc_id = int(request.args.get('doc_id'))
-    return summarizer.getSummary(searcher.path_mapper.get_path_by_id(doc_id))
+    return summarizer.getSummary(get_searcher().path_mapper.get_path_by_id(doc_id))
     
 if __name__ == '__main__':
     print(pyfiglet.figlet_format('CS121 A3 G100', font = 'slant'))
@@ -1,53 +1,162 @@
-import re
 import json
-from bs4 import BeautifulSoup, NavigableString, Comment, Declaration
-from textblob import Word
-import warnings
+import hashlib
+import os
+import re
+import sqlite3
+from collections import Counter
+from functools import lru_cache
+from itertools import chain
+import orjson
+from lxml import etree, html
+from nltk.corpus import wordnet
+from nltk.stem import WordNetLemmatizer
 
-def _ignore_nested_tags(element):
-    """
-    Takes an element from HTML and removes all nested tags
-    """
-    for string in element:
-        if isinstance(string, NavigableString) and not isinstance(string, Comment) and not isinstance(string, Declaration):
-            yield string
+from index.defs import app_data_dir
+
+# Byte translation table that lowercases ASCII alphanumerics and turns every other byte into a
+# space, so an ASCII-encoded phrase can be tokenized with a plain split().
+_TOKEN_TABLE = bytes(
+    ord(chr(byte).lower()) if chr(byte).isascii() and chr(byte).isalnum() else ord(' ')
+    for byte in range(256))
+
+# Matches tokens in a phrase that is not pure ASCII. \d also matches non-ASCII decimal digits (e.g.
+# fullwidth or Arabic-Indic ones), which the byte table can't represent.
+_TOKEN_RE = re.compile(r'[a-zA-Z\d]+')
+
+# Shared lemmatizer. WordNet is loaded lazily by nltk, so force it here rather than on the first
+# lemmatized token.
+_LEMMATIZER = WordNetLemmatizer()
+wordnet.ensure_loaded()
+
+# Tags whose text BeautifulSoup's get_text() leaves out (it is not visible page content). Applies to
+# everything nested inside them as well.
+_NON_CONTENT_TAGS = {'script', 'style', 'template', 'rt', 'rp'}
+
+# Cache of tokenized pages keyed by a hash of their content, so rebuilding an index over unchanged
+# pages skips parsing and tokenizing them.
+# (pid, connection, last rowid when opened) of this process's connection to the cache.
+_tokens_cache = None
+# Keys of pages served from the cache that are still to be moved to its most recently used end.
+# Those still pending when a process exits keep their older place in the cache.
+_tokens_cache_hits = []
+# Part of the cache keys. Bump it whenever tokenizing changes (e.g. tokenize(), the lemmatizer or
+# the tag attribution), so that pages tokenized the old way are not served from the cache.
+_TOKENIZER_VERSION = 2
+# Max number of tokenized pages kept in the cache. Least recently used pages beyond it are evicted
+# whenever a process opens the cache.
+_TOKENS_CACHE_MAX_PAGES = 100000
+# Number of cache hits whose pages are moved to the most recently used end in one write, so that a
+# rebuild over cached pages doesn't need a write transaction per page.
+_TOKENS_CACHE_HITS_BATCH = 256
 
 def tokenize(string):
     """
-    Returns an array of all the tokens in the given phrase.
+    Returns an array of all the tokens in the given phrase: lowercased runs of ASCII letters and
+    decimal digits (including non-ASCII ones such as '١٢٣'). Any other character separates tokens.
     Runs in O(n) time where n is the number of words in the phrase
 
     Args:
        string: phrase to tokenize
 
     Returns:
-        generator: generates list of tokens
+        list: list of tokens
+    """
+
+    if not string.isascii():
+        return [word.lower() for word in _TOKEN_RE.findall(string)]
+
+    # Lowercasing and separating happen in one C-level pass over the bytes.
+    return string.encode('ascii').translate(_TOKEN_TABLE).decode('ascii').split()
+
+@lru_cache(maxsize = 8192)
+def tokenize_query(query):
+    """
+    Returns the tokens of a search query. Cached, as the same short queries are tokenized repeatedly
+    (once per ranked document, and across searches). Page text is rarely repeated, so it should use
+    the uncached tokenize() instead.
+
+    Args:
+       query: search query to tokenize
+
+    Returns:
+        tuple: tuple of tokens
+    """
+    return tuple(tokenize(query))
+
+@lru_cache(maxsize = 262144)
+def lemmatize_token(token):
     """
+    Returns the (noun) lemma of a token. Results are cached, as the same tokens repeat heavily
+    across pages.
 
-    return (word.lower() for word in re.sub(r'[^a-zA-Z\d]', " ", string).split())
+    Args:
+        token: str - token to lemmatize
+
+    Returns:
+        str - lemmatized token
+    """
+    return _LEMMATIZER.lemmatize(token)
 
 def compute_word_frequencies(tokens):
     """
     Calculates the frequency of each word in the given array.
-    Runs in O(n) time where n is the number of words in the list, assuming the time complexity
-    of dictionary.get() is O(1). Worse case, dictionary.get() runs in O(n) time
-    which makes this function run in O(n^2).
+    Runs in O(n) time where n is the number of words in the list. Counting is done by Counter's
+    C implementation.
 
     Args:
         tokens(list): list of words
 
     Returns:
-        dict: Dictionary with the word as the index and the count as the value
+        Counter: Dictionary with the word as the index and the count as the value
+    """
+    return Counter(tokens)
+
+def _get_tokens_cache() -> sqlite3.Connection:
+    """
+    Returns this process's connection to the tokens cache, opening it if needed. Connections can't
+    be shared across processes, so each indexing worker opens its own.
     """
-    countMap = {}
-    
-    for token in tokens:
-        countMap[token] = countMap.get(token, 0) + 1
+    global _tokens_cache
+
+    if _tokens_cache is None or _tokens_cache[0] != os.getpid():
+        _tokens_cache_hits.clear() # Inherited from the parent process, which records its own.
+
+        path = app_data_dir() / 'tokens.sqlite'
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        connection = sqlite3.connect(path, timeout = 60)
+        # Write-ahead logging lets the worker processes read while another one writes.
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        # Rows are kept in use order (most recent last) by their rowid, see
+        # tokenize_JSON_file_with_tags.
+        connection.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT)')
+        connection.execute(
+            'DELETE FROM tokens WHERE rowid IN '
+            '(SELECT rowid FROM tokens ORDER BY rowid DESC LIMIT -1 OFFSET ?)',
+            (_TOKENS_CACHE_MAX_PAGES,))
+        connection.commit()
+        last_rowid = connection.execute('SELECT COALESCE(MAX(rowid), 0) FROM tokens').fetchone()[0]
+        _tokens_cache = (os.getpid(), connection, last_rowid)
 
-    return countMap
+    return _tokens_cache[1]
 
-def get_soup_from_JSON(path) -> BeautifulSoup:
-    """"
+def _commit_tokens_cache(cache):
+    """
+    Moves the pages hit since the last commit to the most recently used end of the tokens cache,
+    then commits.
+
+    Args:
+        cache: this process's connection to the tokens cache
+    """
+    cache.executemany(
+        'UPDATE tokens SET rowid = (SELECT MAX(rowid) FROM tokens) + 1 WHERE key = ?',
+        ((key,) for key in _tokens_cache_hits))
+    cache.commit()
+    _tokens_cache_hits.clear()
+
+def get_content_from_JSON(path) -> str:
+    """
     Returns the content field from the provided JSON file
 
     Args:
@@ -56,21 +165,73 @@ def get_soup_from_JSON(path) -> BeautifulSoup:
     Returns:
         str - content field of JSON
     """
-    with open(path, 'r') as file:
-        obj = json.load(file) # convert json to dictionary
+    with open(path, 'rb') as file:
+        data = file.read()
 
-        with warnings.catch_warnings(record=True) as w:
-            warnings.simplefilter("always")
+    try:
+        obj = orjson.loads(data) # convert json to dictionary
+    except orjson.JSONDecodeError:
+        # orjson is stricter than json, e.g. it rejects the lone surrogates some crawled pages have.
+        obj = json.loads(data)
 
-            try:
-                soup = BeautifulSoup(obj['content'], 'lxml')
-            except Exception as e:
-                print(f'Error parsing HTML with warning: {e}, path: {path}')
-                return
+    return obj['content']
 
-        return soup
+def _get_root_from_content(content, path):
+    """
+    Parses a JSON file's content field into an lxml tree.
 
-    pass
+    Args:
+        content: str - content field of the JSON file
+        path: Path to JSON file, for error reporting
+
+    Returns:
+        lxml root element of the content field, or None if there is no parsable content
+    """
+    try:
+        try:
+            return html.document_fromstring(content)
+        except ValueError:
+            # lxml refuses str input carrying an encoding declaration.
+            return html.document_fromstring(content.encode('utf-8'))
+    except etree.ParserError:
+        return # No content.
+    except Exception as e:
+        print(f'Error parsing HTML with warning: {e}, path: {path}')
+        return
+
+def _iter_strings(root, explicit_tags=()):
+    """
+    Generates the visible text nodes of an lxml tree in document order, each paired with its
+    nearest enclosing explicit tag. Matches the strings BeautifulSoup's get_text() would join.
+
+    Args:
+        root: lxml root element
+        explicit_tags: tags to attribute text to. Text outside all of them is attributed to "other"
+
+    Returns:
+        generator: generates (string, tag) tuples
+    """
+    skipping = 0 # Depth of currently open non-content tags.
+    enclosing = ["other"] # Stack of currently open explicit tags.
+
+    for event, element in etree.iterwalk(root, events = ('start', 'end', 'comment', 'pi')):
+        if event == 'start':
+            if element.tag in _NON_CONTENT_TAGS:
+                skipping += 1
+            if element.tag in explicit_tags:
+                enclosing.append(element.tag)
+            if not skipping and element.text:
+                yield element.text, enclosing[-1]
+            continue
+
+        # Element closed (or comment/processing instruction) - its tail belongs to the parent.
+        if event == 'end':
+            if element.tag in _NON_CONTENT_TAGS:
+                skipping -= 1
+            if element.tag in explicit_tags:
+                enclosing.pop()
+        if not skipping and element.tail and element is not root:
+            yield element.tail, enclosing[-1]
 
 def tokenize_JSON_file(path, lemmatize=True):
     """
@@ -84,63 +245,77 @@ def tokenize_JSON_file(path, lemmatize=True):
     Returns:
         generator: generates list of tokens in json.content property
     """
-    soup = get_soup_from_JSON(path)
-    if not soup:
-        return
+    root = _get_root_from_content(get_content_from_JSON(path), path)
+    if root is None:
+        return iter(())
 
-    return ((Word(token).lemmatize() if lemmatize else token) for token in tokenize(soup.get_text(' ')))
+    # Tokenize text node by text node rather than joining the whole page's text first.
+    tokens = chain.from_iterable(tokenize(string) for string, _ in _iter_strings(root))
+    return (lemmatize_token(token) for token in tokens) if lemmatize else tokens
 
-def tokenize_JSON_file_with_tags(path, explicit_tags):
+def tokenize_JSON_file_with_tags(path, explicit_tags, content=None, use_cache=True):
     """
     Tokenizes a JSON file but attaches the tag frequencies with each token.
 
     Args:
         path: str - path to JSON file
         explicit_tags - list[str] - list of tags that should be explicitly defined in the frequency dict
+        content: optional content field of the JSON file, if the caller already read it
+        use_cache: whether to read and write the tokens cache. Disable it to always tokenize
     Returns:
         dict: index is lemmatized tokens and value is dict[str, int] where index is HTML tag and value is frequency
     """
-    dict_tags = explicit_tags + ["other"]
-    
-    soup = get_soup_from_JSON(path)
-    if not soup:
-        return dict()
+    # Zeroed tag frequencies, copied for each newly seen token.
+    template = dict.fromkeys(explicit_tags + ["other"], 0)
 
-    total_frequencies = compute_word_frequencies(Word(token).lemmatize() for token in tokenize(soup.get_text(' ')))
+    if content is None:
+        content = get_content_from_JSON(path)
+
+    if use_cache:
+        # The result depends on the tokenizer, the explicit tags and the content.
+        key = hashlib.blake2b(
+            f"{_TOKENIZER_VERSION} {' '.join(explicit_tags)}".encode(), digest_size = 16)
+        key.update(content.encode('utf-8', 'surrogatepass'))
+        key = key.hexdigest()
+
+        cache = _get_tokens_cache()
+        row = cache.execute('SELECT rowid, tokens FROM tokens WHERE key = ?', (key,)).fetchone()
+        if row:
+            # Pages added or moved since this process opened the cache (e.g. by another worker of
+            # the same build) are recent enough. Others are moved in batches, along with the
+            # next write.
+            if row[0] <= _tokens_cache[2]:
+                _tokens_cache_hits.append(key)
+                if len(_tokens_cache_hits) >= _TOKENS_CACHE_HITS_BATCH:
+                    _commit_tokens_cache(cache)
+            return orjson.loads(row[1])
 
     # lemmatized token = {tag_frequencies}
     tag_frequencies = dict()
 
-    # explicit tags:
-    for tag in explicit_tags:
-        for soup_tag in soup.find_all(tag):
-            string = " ".join(_ignore_nested_tags(soup_tag))
-            if string == None:
-                continue
-                
-            frequencies = compute_word_frequencies(Word(token).lemmatize() for token in tokenize(string))
-
-            for token, frequency in frequencies.items():
-                frequency_dict = tag_frequencies.get(token, dict.fromkeys(dict_tags, 0))
-                frequency_dict[tag] = frequency_dict.get(tag) + frequency
-                
-                tag_frequencies[token] = frequency_dict
-    
-    # miscellaneous
-    for token, total_frequency in total_frequencies.items():
-        frequencies = tag_frequencies.get(token) or dict.fromkeys(dict_tags, 0)
-
-        total = 0
-        if frequencies != None:
-            for frequency in frequencies.values():
-                total += frequency
-
-        other_frequency = total_frequency - total
-        frequencies["other"] = other_frequency
-
-        if other_frequency < 0:
-            raise Exception(f'Negative other score: {path}, {token}, {frequencies}')
-
-        tag_frequencies[token] = frequencies
-        
+    root = _get_root_from_content(content, path)
+    if root is None:
+        return tag_frequencies
+
+    # Single pass over the page's text - each string counts towards its nearest explicit tag.
+    # Raw tokens are counted per tag in C (Counter.update), so the per-token Python work below only
+    # runs once per unique token and tag.
+    tag_counts = {tag: Counter() for tag in template}
+    for string, tag in _iter_strings(root, explicit_tags):
+        tag_counts[tag].update(tokenize(string))
+
+    for tag, counts in tag_counts.items():
+        for token, count in counts.items():
+            token = lemmatize_token(token)
+
+            frequencies = tag_frequencies.get(token)
+            if frequencies is None:
+                frequencies = tag_frequencies[token] = template.copy()
+            frequencies[tag] += count
+
+    if use_cache:
+        cache.execute(
+            'INSERT OR REPLACE INTO tokens VALUES (?, ?)', (key, orjson.dumps(tag_frequencies)))
+        _commit_tokens_cache(cache)
+
     return tag_frequencies
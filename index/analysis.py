@@ -4,6 +4,19 @@ def generate_analysis(InvertedIndex) -> None:
     print(f"Analysis of InvertedIndex with name: {InvertedIndex.name}")
     print("-" * 40)
     print(f"# of indexed documents: {InvertedIndex.page_count}")
-    print(f"# of unique words: {sum(1 for _ in InvertedIndex)}")
-    print(f"Total size of index on disk: {sum(os.path.getsize(path) for path in InvertedIndex.disks) / 1024} KB")
+
+    # One walk over the index's directory, counting the tokens of each partition (from its entry
+    # headers only) while totalling file sizes.
+    partitions = set(map(str, InvertedIndex.disks))
+    unique_words, size = 0, 0
+    for entry in os.scandir(InvertedIndex.directory):
+        if not entry.is_file():
+            continue
+
+        size += entry.stat().st_size
+        if entry.path in partitions:
+            unique_words += InvertedIndex.token_count_of(entry.path)
+
+    print(f"# of unique words: {unique_words}")
+    print(f"Total size of index on disk: {size / 1024:,.1f} KB")
 
@@ -1,9 +1,19 @@
 # The name of the entire A3 application.
+import functools
 from pathlib import Path
 
 import platformdirs
 
 
 APP_NAME = 'CS121_A3'
-# Local data dir for this application.
-APP_DATA_DIR = Path(platformdirs.user_data_dir(APP_NAME))
+
+@functools.cache
+def app_data_dir() -> Path:
+    """
+    Local data dir for this application. Resolved on first use rather than at import, as
+    platformdirs inspects the platform and environment to find it.
+
+    Returns:
+        Path to the data dir.
+    """
+    return Path(platformdirs.user_data_dir(APP_NAME))
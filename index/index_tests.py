@@ -1,20 +1,27 @@
 import cProfile
+import collections
+import functools
+import os
 import pstats
 import shutil
+import signal
+import subprocess
+import sys
+import tempfile
 import threading
 import time
 import unittest
 from cProfile import Profile
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from types import MethodType
 from unittest.mock import patch
 
 import psutil
 
-from index import InvertedIndex
-from index.inverted_index import _WEIGHTED_TAGS
+from index import InvertedIndex, JSONtokenizer
+from index.inverted_index import _SIMHASH_BANDS, _WEIGHTED_TAGS
+from index._simhash import simhash
 from index.JSONtokenizer import tokenize_JSON_file_with_tags, compute_word_frequencies, tokenize_JSON_file
 from index.posting_pb2 import Posting
 from index.path_mapper import PathMapper
@@ -25,6 +32,72 @@ SMALL_DATASET = '../developer/DEV/alderis_ics_uci_edu'
 MEDIUM_DATASET = '../developer/DEV/archive_ics_uci_edu'
 LARGEST_DATASET = '../developer'
 
+# Lines logged by log_call, buffered rather than printed so that logging stays cheap on hot paths
+# (e.g. a flush per document). Printed by flush_call_log.
+_call_log = collections.deque(maxlen = 10000)
+
+@functools.cache
+def dataset_pages(datasource: str, flat: bool = False) -> tuple[Path, ...]:
+    """
+    Get the page .json files of a dataset. Cached, so each dataset's directory tree is only walked
+    once per test run.
+
+    Args:
+        datasource: Root directory of the dataset.
+        flat: Whether the dataset's pages all sit directly in its root directory (e.g. a single
+        domain of DEV), in which case subdirectories are not searched.
+
+    Returns:
+        Paths to the dataset's pages.
+    """
+    return tuple(Path(datasource).glob('*.json') if flat else Path(datasource).rglob('*.json'))
+
+def tokenize_page_with_tags(path: str) -> dict[str, dict[str, int]]:
+    """
+    Tokenize a page with the index's weighted tags. Module-level so that it can run in worker
+    processes. Bypasses the tokens cache, so that the expected values don't come from the index
+    build being tested.
+
+    Args:
+        path: Path to the page .json file.
+
+    Returns:
+        Dict of tokens to their tag frequencies.
+    """
+    return tokenize_JSON_file_with_tags(path, _WEIGHTED_TAGS, use_cache = False)
+
+@functools.cache
+def dataset_tag_frequencies(datasource: str) -> tuple[dict[str, dict[str, int]], ...]:
+    """
+    Tokenize each page of a flat dataset with the index's weighted tags. Cached, so tests sharing a
+    dataset only tokenize it once per test run. Pages are tokenized in parallel.
+
+    Args:
+        datasource: Root directory of the dataset.
+
+    Returns:
+        Dicts of tokens to their tag frequencies, in the order of the dataset's pages.
+    """
+    paths = map(str, dataset_pages(datasource, flat = True))
+    with ProcessPoolExecutor() as executor:
+        return tuple(executor.map(tokenize_page_with_tags, paths, chunksize = 32))
+
+def expected_posting(doc_id: int, tag_freqs: dict[str, int]) -> Posting:
+    """
+    Build the posting the index should store for a page's token.
+
+    Args:
+        doc_id: Id of the page.
+        tag_freqs: The token's tag frequencies in the page.
+
+    Returns:
+        Posting of the token in the page. Tags with no occurrences are left out, and so is the
+        total frequency (derived from the tag frequencies).
+    """
+    return Posting(
+        doc_id = doc_id,
+        tag_frequencies = {tag: freq for tag, freq in tag_freqs.items() if freq})
+
 def print_trunc(o, chars: int = 500):
     """
     Print, but truncate.
@@ -45,19 +118,19 @@ def wrap(func, before = None, after = None):
         before: Function to run before the original method is invoked.
         after: Function to run after the original method is invoked.
     """
-    obj = func.__self__
-
-    def wrapped(self, *args, **kwargs):
-        if before:
-            before(*args, **kwargs)
-        res = func(*args, **kwargs)
-        if after:
-            after(*args, **kwargs)
+    # func is already bound, so the wrapper is set as a plain instance attribute. The callables are
+    # bound as defaults so that they are fast locals within the wrapper.
+    def wrapped(*args, _func = func, _before = before, _after = after, **kwargs):
+        if _before:
+            _before(*args, **kwargs)
+        res = _func(*args, **kwargs)
+        if _after:
+            _after(*args, **kwargs)
         return res
 
     wrapped.__name__ = func.__name__
 
-    setattr(obj, func.__name__, MethodType(wrapped, obj))
+    setattr(func.__self__, func.__name__, wrapped)
 
 def log_call(func):
     """
@@ -66,48 +139,85 @@ def log_call(func):
     Args:
         func: The function to log calls.
     """
+    # Resolved once, rather than on every logged call.
+    name = f'{f'{func.__self__.__class__.__name__}.' if func.__self__ else ''}{func.__name__}'
+
     def after(*args, **kwargs):
-        print(f'[{datetime.now().strftime('%H:%M:%S')}] '
-              f'{f'{func.__self__.__class__.__name__}.' if func.__self__ else ''}'
-              f'{func.__name__}({args}, {kwargs}) called')
+        _call_log.append(f'[{time.strftime('%H:%M:%S')}] {name}({args}, {kwargs}) called')
 
     wrap(func, after = after)
 
+def flush_call_log():
+    """
+    Print out and clear the invocations buffered by log_call.
+    """
+    if _call_log:
+        sys.stdout.write('\n'.join(_call_log) + '\n')
+        _call_log.clear()
+
 class MemPoll:
     """
-    Context manager that prints out memory stats every second while alive. Operates in a background
-    thread.
+    Context manager that polls memory stats every second while alive, and prints them out on exit.
+    Operates in a background thread. Opt-in: a no-op unless the MEMPOLL environment variable is set,
+    so that it does not perturb profiled runs.
     """
     def __init__(self):
         self.stop = threading.Event()
+        self.log = collections.deque(maxlen = 1024) # Most recent stats.
 
     def __enter__(self):
-        def poll(stop):
+        if not os.environ.get('MEMPOLL'):
+            return self
+
+        def poll(stop, log):
             while not stop.is_set():
                 mem = psutil.virtual_memory()
-                print(f'Available memory: {mem.available} / {mem.total} ({mem.percent}%)')
-                time.sleep(1)
+                log.append(f'Available memory: {mem.available} / {mem.total} ({mem.percent}%)')
+                stop.wait(1) # Wakes early on exit, so the thread can be joined right away.
 
-        threading.Thread(target = poll, args = (self.stop,), daemon = True).start()
+        self.thread = threading.Thread(target = poll, args = (self.stop, self.log), daemon = True)
+        self.thread.start()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop.set()
+        if hasattr(self, 'thread'):
+            self.thread.join()
+
+        if self.log:
+            sys.stdout.write('\n'.join(self.log) + '\n')
 
 class IndexTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The index correctness tests only read from the index, so build it once and share it.
+        # Named per run so that concurrent runs do not clobber each other's disk. Every page is
+        # expected in the index, so near-duplicates are not skipped.
+        cls.index = InvertedIndex(
+            SMALL_DATASET,
+            name = f'test_index_shared_{os.getpid()}',
+            postings_flush_count = 500,
+            persist = True,
+            no_duplicate_detection = True,
+            use_tokens_cache = False
+        )
+
+    def tearDown(self):
+        flush_call_log()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.index.directory, ignore_errors = True)
+
     def test_index_all_tokens_present(self):
         """
         Tests that all tokens are reflected and accessible from the inverted index.
         """
         datasource = SMALL_DATASET
-        index = InvertedIndex(
-            datasource,
-            name = 'test_index_all_tokens_present',
-            postings_flush_count = 500,
-            persist = True
-        )
+        index = self.index
 
         expected_tokens = set()
-        for p in Path(datasource).rglob('*.json'):
+        for p in dataset_pages(datasource, flat = True):
             expected_tokens.update(set(compute_word_frequencies(tokenize_JSON_file(str(p))).keys()))
 
         self.assertEqual(expected_tokens, set(index))
@@ -117,58 +227,186 @@ class IndexTests(unittest.TestCase):
         Tests that all postings are accurately present in the inverted index, for each token.
         """
         datasource = SMALL_DATASET
-        index = InvertedIndex(
-            datasource,
-            name = 'test_index_all_postings_present',
-            postings_flush_count = 500,
-            persist = True
-        )
+        index = self.index
 
-        in_memory_index: dict[str, list[Posting]] = defaultdict(list)
         mapper = PathMapper(str(Path(datasource)))
-        for p in Path(datasource).rglob('*.json'):
-            doc_id = mapper.get_id(str(p))
-            for token, tag_freqs in tokenize_JSON_file_with_tags(str(p), _WEIGHTED_TAGS).items():
-                in_memory_index[token].append(Posting(
-                    doc_id = doc_id,
-                    frequency = sum(tag_freqs.values()),
-                    tag_frequencies = tag_freqs))
-
-        self.assertEqual(sorted(in_memory_index.items()), list(index.items()))
+        paths = tuple(map(str, dataset_pages(datasource, flat = True)))
+        ids = tuple(map(mapper.get_id, paths))
+        token_maps = dataset_tag_frequencies(datasource)
+
+        # Group (doc_id, tag_freqs) by token first, then build the postings in one batch.
+        raw_index: dict[str, list[tuple[int, dict[str, int]]]] = {}
+        for doc_id, token_map in zip(ids, token_maps):
+            for token, tag_freqs in token_map.items():
+                raw_index.setdefault(token, []).append((doc_id, tag_freqs))
+
+        in_memory_index: dict[str, list[Posting]] = {
+            token: [expected_posting(doc_id, tag_freqs) for doc_id, tag_freqs in postings]
+            for token, postings in raw_index.items()
+        }
+
+        # Stream the index alongside the sorted expected tokens rather than materializing both
+        # sides, stopping at the first mismatching token.
+        expected_tokens = sorted(in_memory_index)
+        for expected_token, (token, entry) in zip(expected_tokens, index.items()):
+            self.assertEqual(expected_token, token)
+            self.assertEqual(in_memory_index[token], list(entry.postings), f'Postings of {token!r}')
+
+        self.assertEqual(len(expected_tokens), len(index))
 
     def test_index_get_postings_by_token(self):
         """
         Tests that the postings of an individual token can be obtained.
         """
         datasource = SMALL_DATASET
-        index = InvertedIndex(
-            datasource,
-            name = 'test_index_get_postings_by_token',
-            postings_flush_count = 500,
-            persist = True
-        )
+        index = self.index
 
         target_token = 'alderis'
         expected_postings: list[Posting] = []
         mapper = PathMapper(str(Path(datasource)))
-        for p in Path(datasource).rglob('*.json'):
-            doc_id = mapper.get_id(str(p))
-            for token, tag_freqs in tokenize_JSON_file_with_tags(str(p), _WEIGHTED_TAGS).items():
-                if token == target_token:
-                    expected_postings.append(Posting(
-                        doc_id = doc_id,
-                        frequency = sum(tag_freqs.values()),
-                        tag_frequencies = tag_freqs))
+        paths = tuple(map(str, dataset_pages(datasource, flat = True)))
+        ids = tuple(map(mapper.get_id, paths))
+        for doc_id, token_map in zip(ids, dataset_tag_frequencies(datasource)):
+            # One lookup per page, rather than a scan over all of its tokens.
+            tag_freqs = token_map.get(target_token)
+            if tag_freqs is None:
+                continue
+
+            expected_postings.append(expected_posting(doc_id, tag_freqs))
 
-        self.assertEqual(expected_postings, list(index[target_token]))
+        self.assertEqual(expected_postings, list(index[target_token].postings))
+
+    def test_index_near_duplicate_detection(self):
+        """
+        Tests that exact and near-duplicate documents (simhashes within 6 bits, i.e. at least 95%
+        similar) are detected, including when the differing bits are spread over different bands,
+        and that other documents are not.
+        """
+        def flip_bits(hashed_doc: bytes, *bits: int) -> bytes:
+            value = int.from_bytes(hashed_doc)
+            for bit in bits:
+                value ^= 1 << bit
+            return value.to_bytes(len(hashed_doc))
+
+        hashed_doc = simhash('the quick brown fox jumps over the lazy dog ' * 20)
+        band_bits = len(hashed_doc) * 8 // _SIMHASH_BANDS
+
+        # Start from no explored documents, without touching the shared index's own.
+        with patch.object(self.index, '_simhash_bands', [{} for _ in range(_SIMHASH_BANDS)]):
+            self.assertFalse(self.index._is_similar(hashed_doc)) # First seen, recorded.
+            self.assertTrue(self.index._is_similar(hashed_doc)) # Exact duplicate.
+
+            # One differing bit in each of 6 different bands.
+            near_duplicate = flip_bits(hashed_doc, *(band * band_bits for band in range(6)))
+            self.assertTrue(self.index._is_similar(near_duplicate))
+
+            # One differing bit in each of 7 different bands - below the similarity threshold.
+            not_duplicate = flip_bits(hashed_doc, *(band * band_bits + 1 for band in range(7)))
+            self.assertFalse(self.index._is_similar(not_duplicate))
+
+            # Entirely different (no band in common).
+            inverse = bytes(byte ^ 0xff for byte in hashed_doc)
+            self.assertFalse(self.index._is_similar(inverse))
+
+    def test_index_multi_pass_merge(self):
+        """
+        Tests that an index whose flushed partitions are merged over several passes (more of them
+        than the merge fan-in) matches one merged in a single pass, and that no flushed partitions
+        are left behind.
+        """
+        # Patched fan-in of 2 with tiny flushes, so that the flushed partitions take several passes.
+        # Each merge of a pass (and the final one) is a call to _merge.
+        with (patch('index.inverted_index._MAX_MERGE_FAN_IN', 2),
+              patch.object(InvertedIndex, '_merge', autospec = True,
+                           side_effect = InvertedIndex._merge) as merge):
+            index = InvertedIndex(
+                SMALL_DATASET,
+                name = f'test_index_multi_pass_merge_{os.getpid()}',
+                postings_flush_count = 50,
+                no_duplicate_detection = True,
+                use_tokens_cache = False
+            )
+
+        self.assertGreater(merge.call_count, 2)
+        self.assertEqual(list(self.index.items()), list(index.items()))
+        self.assertEqual([], list(index.directory.glob('flushed_*.bin')))
+
+    def test_tokens_cache(self):
+        """
+        Tests that pages served from the tokens cache match tokenizing them, that the least recently
+        used pages are evicted beyond the cache's max size, and that pages cached by another
+        tokenizer version are not served.
+        """
+        pages = dataset_pages(SMALL_DATASET, flat = True)[:3]
+        expected = [tokenize_page_with_tags(page) for page in pages]
+
+        def reopen_cache():
+            JSONtokenizer._tokens_cache[1].close()
+            JSONtokenizer._tokens_cache = None
+
+        def tokenize_cached(page) -> tuple[dict[str, dict[str, int]], bool]:
+            # Also returns whether the page was parsed, i.e. not served from the cache.
+            with patch('index.JSONtokenizer._get_root_from_content',
+                       wraps = JSONtokenizer._get_root_from_content) as parse:
+                return tokenize_JSON_file_with_tags(page, _WEIGHTED_TAGS), parse.called
+
+        # A cache of its own, rather than the one shared with regular index builds.
+        with (tempfile.TemporaryDirectory() as data_dir,
+              patch('index.JSONtokenizer.app_data_dir', return_value = Path(data_dir)),
+              patch('index.JSONtokenizer._tokens_cache', None),
+              patch('index.JSONtokenizer._tokens_cache_hits', []),
+              patch('index.JSONtokenizer._TOKENS_CACHE_HITS_BATCH', 1)):
+            for page, tag_frequencies in zip(pages, expected):
+                self.assertEqual((tag_frequencies, True), tokenize_cached(page)) # Cached.
+            for page, tag_frequencies in zip(pages, expected):
+                self.assertEqual((tag_frequencies, False), tokenize_cached(page)) # Hit.
+
+            # Hits only refresh pages cached before the cache was opened, so reopen it first. The
+            # first page is then the most recently used, and the second the least.
+            reopen_cache()
+            tokenize_cached(pages[0])
+            reopen_cache()
+            with patch('index.JSONtokenizer._TOKENS_CACHE_MAX_PAGES', 2):
+                self.assertEqual((expected[0], False), tokenize_cached(pages[0]))
+                self.assertEqual((expected[2], False), tokenize_cached(pages[2]))
+                self.assertEqual((expected[1], True), tokenize_cached(pages[1])) # Evicted.
+
+            version = JSONtokenizer._TOKENIZER_VERSION + 1
+            with patch('index.JSONtokenizer._TOKENIZER_VERSION', version):
+                self.assertEqual((expected[0], True), tokenize_cached(pages[0]))
+
+            JSONtokenizer._tokens_cache[1].close()
 
     @patch('builtins.input', side_effect=[
         'alderis', 'brain cat dog', 'the', 'zhu', 'a', 'master of software engineering',
         'uci', 'ics', 'irvine', 'exit']
     )
     def test_index_performance(self, _):
-        profiler = cProfile.Profile()
-        profiler.enable()
+        # Prefer py-spy: it samples the process from outside rather than instrumenting every call,
+        # so the run is not slowed down and the many short tokenizer/protobuf calls are not inflated.
+        # Falls back to cProfile when py-spy is not installed or can't sample. Not used on Windows,
+        # where it can't be stopped with SIGINT.
+        py_spy = shutil.which('py-spy') if os.name != 'nt' else None
+        sampler = None
+        if py_spy:
+            sampler = subprocess.Popen([
+                py_spy, 'record',
+                '-o', str(self.profile_path('test_index_performance', 'svg')),
+                '-p', str(os.getpid()),
+                '--native'
+            ])
+            try:
+                # Attaching to this process fails right away without ptrace permissions (e.g. Linux
+                # with yama ptrace_scope=1, or macOS without sudo).
+                sampler.wait(timeout = 1)
+                print(f'py-spy exited with code {sampler.returncode}, profiling with cProfile')
+                sampler = None
+            except subprocess.TimeoutExpired:
+                pass # Sampling.
+
+        if not sampler:
+            profiler = cProfile.Profile()
+            profiler.enable()
 
         try:
             CLIApp(
@@ -180,6 +418,12 @@ class IndexTests(unittest.TestCase):
         except SystemExit:
             pass
 
+        if sampler:
+            # py-spy writes out its flame graph once interrupted.
+            sampler.send_signal(signal.SIGINT)
+            self.assertEqual(0, sampler.wait(), 'py-spy failed to record a profile')
+            return
+
         profiler.disable()
 
         stats = pstats.Stats(profiler)
@@ -191,7 +435,8 @@ class IndexTests(unittest.TestCase):
         profiler = cProfile.Profile()
         profiler.enable()
 
-        InvertedIndex(MEDIUM_DATASET, name = 'test_index_build_performance')
+        # Without the tokens cache, so that every run measures tokenizing rather than cache hits.
+        InvertedIndex(MEDIUM_DATASET, name = 'test_index_build_performance', use_tokens_cache = False)
 
         profiler.disable()
 
@@ -206,7 +451,8 @@ class IndexTests(unittest.TestCase):
 
         InvertedIndex(MEDIUM_DATASET,
                       name = 'test_dev_index_build_performance',
-                      no_duplicate_detection = True)
+                      no_duplicate_detection = True,
+                      use_tokens_cache = False)
 
         profiler.disable()
 
@@ -216,12 +462,14 @@ class IndexTests(unittest.TestCase):
         self.dump_stats('test_dev_index_build_performance', profiler)
 
     def dump_stats(self, name: str, profiler: Profile):
+        profiler.dump_stats(self.profile_path(name, 'prof'))
+
+    def profile_path(self, name: str, extension: str) -> Path:
         stats_dir = Path(f'../build/stats/{name}')
         shutil.rmtree(stats_dir, ignore_errors = True)
         stats_dir.mkdir(exist_ok = True, parents = True)
 
-        profiler.dump_stats(stats_dir / f'profile_{datetime.now()
-                            .strftime("%m-%d_%H-%M-%S")}.prof')
+        return stats_dir / f'profile_{datetime.now().strftime("%m-%d_%H-%M-%S")}.{extension}'
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,49 +1,42 @@
 import bisect
+import functools
 import heapq
 import logging
+import mmap
+import multiprocessing
+import os
 import shutil
 import struct
-import subprocess
-import sys
 import time
-import json
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from typing import BinaryIO, Generator
+from typing import Generator, Iterable
 
+import orjson
 import psutil
+from google.protobuf.message import DecodeError
 
-from index.JSONtokenizer import tokenize_JSON_file_with_tags
-from index.defs import APP_DATA_DIR
+from index.JSONtokenizer import get_content_from_JSON, tokenize_JSON_file_with_tags
+from index.defs import app_data_dir
 from index.path_mapper import PathMapper
 from index._simhash import simhash, calculate_similarity_score
 
-logger = logging.getLogger(__name__)
-
-current_dir = Path(__file__).resolve().parent
-
-proto_file = current_dir / 'posting.proto'
-logger.debug(f'Generating protobuf source classes for {proto_file}')
-result = subprocess.run(
-    ['protoc', f'--proto_path={current_dir}', f'--python_out={current_dir}', proto_file],
-    capture_output = True, text = True)
-
-if result.returncode != 0:
-    raise RuntimeError(result.stderr)
-
-logger.debug('Successfully generated protobuf source classes')
-
-# These may have error squiggles, but these will resolve correctly at runtime.
-# Dynamically generated classes and module from the above script. Import must be placed after
-# the script.
 from index.posting_pb2 import Posting, TokenEntry
 
-_INDEXES_DIR = APP_DATA_DIR / 'indexes'
+logger = logging.getLogger(__name__)
 
 # The default number of in-memory postings before writing to disk.
 # Generally, this also doubles as the max in-memory postings for any operation.
 _DEFAULT_POSTINGS_FLUSH_COUNT = 5e4
 
+# System memory usage (percent) at which in-memory postings are flushed before reaching the flush
+# count. Only applies once at least the given fraction of the flush count is in memory, so that
+# memory pressure from elsewhere doesn't cause a flush (and a tiny partition) per page.
+_MEMORY_FLUSH_PERCENT = 80
+_MEMORY_FLUSH_MIN_FRACTION = 0.1
+
 # The default number of in-memory postings in each partition of the merged index.
 # The actual number of postings may be higher, as token postings are not split between partitions
 # (i.e. if the partition size is almost reached and a token with a massive number of entries comes
@@ -52,6 +45,30 @@ _DEFAULT_PARTITION_SIZE = 5e3
 
 _WEIGHTED_TAGS = ["h1", "h2", "h3", "title", "b", "strong"]
 _SIMILARITY_THRESHOLD = 0.95
+# Number of equal-width bands each simhash is split into for near-duplicate lookup. Two 128-bit
+# simhashes at the similarity threshold differ in at most 6 bits, so (by pigeonhole) at least 2 of
+# 8 bands are identical - looking up candidates by band finds every near-duplicate.
+_SIMHASH_BANDS = 8
+
+# Max number of partitions merged at once. Each is kept open (memory mapped) while merging, so with
+# more flushed partitions than this (e.g. many early flushes under memory pressure), they are first
+# merged in several passes rather than exhausting the open file limit.
+_MAX_MERGE_FAN_IN = 64
+
+# Number of pages handed to a tokenizer worker process at a time. Amortizes the IPC overhead of
+# sending paths and receiving token frequencies.
+_TOKENIZE_CHUNKSIZE = 16
+
+# Encoding of the token and token entry lengths preceding each entry on disk. Fixed as 4 byte
+# little-endian, rather than native, so that index files read the same on any platform.
+_LENGTH = struct.Struct('<I')
+
+# Wire format key (field number 1, varint) of TokenEntry.df. Serialized entries start with it, as
+# fields are serialized in field number order and df is never 0 for a stored token.
+_DF_KEY = 0x08
+
+# Max number of partitions whose term offsets are kept in memory for lookups at a time.
+_TERM_OFFSETS_CACHE_SIZE = 64
 
 
 class InvertedIndex:
@@ -64,12 +81,15 @@ class InvertedIndex:
         name: Custom name for the inverted index on disk. Defaults to 'index_<obj_hash>'
         postings_flush_count In-memory posting limit restricting the max postings existing in
         memory before being flushed to disk, and the max postings that can be read from disk at a
-        time.
+        time. While building, postings are also flushed earlier if system memory runs low.
         partition_posting_size: The max postings count for a final sorted partition.
         persist: Whether NOT to delete the index's disk once its InvertedIndex object is garbage
         collected.
         load_existing: Whether to load an existing inverted index from disk into this object, if
         a matching index exists (by name).
+        no_duplicate_detection: Whether to index near-duplicate pages rather than skipping them.
+        use_tokens_cache: Whether to reuse (and record) tokenized pages from the on-disk tokens
+        cache when building. Disable it to always tokenize pages (e.g. to test or profile it).
     """
     def __init__(self, root_dir: str | Path, *,
                  name: str = '',
@@ -77,22 +97,33 @@ class InvertedIndex:
                  partition_posting_size: int = _DEFAULT_PARTITION_SIZE,
                  persist: bool = False,
                  load_existing: bool = False,
-                 no_duplicate_detection: bool = False):
+                 no_duplicate_detection: bool = False,
+                 use_tokens_cache: bool = True):
         logger.debug('Initializing new InvertedIndex')
 
         self.postings_flush_count = postings_flush_count
         self.partition_posting_size = partition_posting_size
         self.persist = persist
         self.no_duplicate_detection = no_duplicate_detection
+        self.use_tokens_cache = use_tokens_cache
 
         self._root_dir = Path(root_dir) # Source dir for this index's pages.
-        self._buf: dict[str, TokenEntry] = defaultdict(TokenEntry) # In-memory portion of the index.
+        # In-memory portion of the index: token -> (doc id, tag frequencies) of its postings. Kept
+        # as plain values, and only built into protobuf messages when flushed.
+        self._buf: dict[str, list[tuple[int, dict[str, int]]]] = defaultdict(list)
         self._mapper = PathMapper(str(self._root_dir), rebuild = not load_existing) # Doc ids.
         self._postings_count = 0 # Current in-memory posting count.
         self._partition_count = 0 # Current number of partitions.
         self._page_count = 0 # Total number of pages indexed.
         self._partitions: list[Path] = [] # Index partition files.
-        self._simhashes = set() # set of documents simhashes
+        # Least token of each partition, in the same (sorted) order as the partitions once built.
+        self._min_tokens: list[str] = []
+        # Simhashes of indexed documents, per band: band bytes -> simhashes having those bytes.
+        self._simhash_bands: list[dict[bytes, list[bytes]]] = [{} for _ in range(_SIMHASH_BANDS)]
+        self._token_count: int | None = None # Number of unique tokens, counted on first use.
+        # Term offsets of recently used partitions (see _get_term_offsets), least recent first.
+        # Only these are kept, rather than a dictionary of the whole index.
+        self._term_offsets: OrderedDict[Path, dict[str, list[int]] | None] = OrderedDict()
 
         self._name = name # Unique name used for loading from disk, if enabled.
 
@@ -100,8 +131,7 @@ class InvertedIndex:
             self._name = f'index-{self.__hash__()}'
             logger.debug(f'No custom inverted index name provided. Defaulting to {self._name}')
 
-        self._out_dir = _INDEXES_DIR / self._name # Location of this index on disk.
-        self._merged_file = self._out_dir / f'merged.bin' # Location of the final merged index.
+        self._out_dir = app_data_dir() / 'indexes' / self._name # Location of this index on disk.
 
         # If conditions are right, build a new inverted index from scratch.
         if not load_existing or not self._out_dir.exists():
@@ -115,11 +145,13 @@ class InvertedIndex:
             self.build() # Build the index. Periodically flushes to disk.
             self.flush() # Flush any remaining in-memory data to disk.
 
-            logger.debug(f'Merging {self._partition_count} partitions for InvertedIndex {self.name}')
-            self._merge() # Merge partitions.
-
-            logger.debug(f'Partitioning the (sorted) merged index for InvertedIndex {self.name}')
-            self._partition()
+            # Merge the flushed partitions, streaming the (sorted) merged index straight into the
+            # final partitions rather than writing it to disk in between.
+            logger.debug(f'Merging {self._partition_count} partitions into the final partitions '
+                         f'for InvertedIndex {self.name}')
+            flushed, self._partitions = self._merge_passes(self._partitions), []
+            self._partition(self._merge(flushed))
+            self._partition_count = 0
 
             mins, secs = divmod(time.time() - start, 60)
             min_fmt = f'{mins}m' if mins else ''
@@ -132,10 +164,6 @@ class InvertedIndex:
             logger.debug(f'Loaded existing InvertedIndex {self.name} from {self._out_dir} '
                          f'This object now manages it.')
 
-        # Speeds up retrieval by processing min tokens of each partition from their paths, doing
-        # this once instead of during each retrieval operation.
-        self._token_ranges = [str(path).split('_')[-1] for path in self.disks]
-
     def __del__(self):
         if not self.persist:
             # Wipe this index's directory, if it exists.
@@ -153,6 +181,13 @@ class InvertedIndex:
         """
         return self._name
 
+    @property
+    def directory(self) -> Path:
+        """
+        Directory containing this index's partitions on disk.
+        """
+        return self._out_dir
+
     @property
     def disks(self) -> list[Path]:
         """
@@ -176,12 +211,50 @@ class InvertedIndex:
             that token.
         """
         for disk in self.disks:
-            with open(disk, 'rb') as f:
-                while True:
-                    try:
-                        yield self._next_entry(f)
-                    except StopIteration:
-                        break
+            yield from self._read_entries(disk)
+
+    def __len__(self) -> int:
+        """
+        Number of unique tokens in this index. Counted once, by reading only the entry headers on
+        disk (postings are skipped over, not decoded).
+
+        Returns:
+            Unique token count.
+        """
+        if self._token_count is None:
+            self._token_count = sum(map(self.token_count_of, self.disks))
+
+        return self._token_count
+
+    @staticmethod
+    def token_count_of(disk: Path | str) -> int:
+        """
+        Number of tokens in a single index partition on disk. Only the entry headers are read
+        (postings are skipped over, not decoded). The file is memory mapped, so headers are
+        decoded in place rather than through read() and seek() calls per entry.
+
+        Args:
+            disk: Path to the partition.
+
+        Returns:
+            Token count of the partition.
+        """
+        count = 0
+        mm = InvertedIndex._map_file(disk)
+        if mm is None:
+            return 0
+
+        with mm:
+            pos = 0
+            # Stops at the end, or at a trailing partial header.
+            while pos + _LENGTH.size <= len(mm):
+                pos += _LENGTH.size + _LENGTH.unpack_from(mm, pos)[0] # Skip token.
+                if pos + _LENGTH.size > len(mm):
+                    break
+                pos += _LENGTH.size + _LENGTH.unpack_from(mm, pos)[0] # Skip postings.
+                count += 1
+
+        return count
 
     def __iter__(self) -> Generator[str, None, None]:
         """
@@ -190,7 +263,10 @@ class InvertedIndex:
         Returns:
             Generator of unique tokens in this index, in order of their placement on disk.
         """
-        yield from map(lambda item: item[0], self.items())
+        # Only the tokens are needed, so the postings are not deserialized.
+        for disk in self.disks:
+            for token, _ in self._read_serialized_entries(disk):
+                yield token
 
     def __getitem__(self, item: str) -> TokenEntry:
         """
@@ -205,9 +281,28 @@ class InvertedIndex:
         if type(item) != str:
             raise TypeError('Indexing item must be a string.')
 
-        for token, postings in self._iter_partition(item):
+        partition = self._get_partition_file(item)
+
+        # Seek straight to the token's entry using the partition's term offsets.
+        term_offsets = self._get_term_offsets(partition)
+        if term_offsets is not None:
+            token_entry = TokenEntry()
+            if item in term_offsets:
+                offset, length = term_offsets[item]
+                with open(partition, 'rb') as f:
+                    f.seek(offset)
+                    token_entry.ParseFromString(f.read(length))
+            return token_entry
+
+        # No term offsets (e.g. an index built before they existed). Partitions are sorted, so
+        # scan up to the token, deserializing only its own postings.
+        for token, token_entry_data in self._read_serialized_entries(partition):
             if token == item:
-                return postings
+                token_entry = TokenEntry()
+                token_entry.ParseFromString(token_entry_data)
+                return token_entry
+            if token > item:
+                break
 
         return TokenEntry()
 
@@ -220,8 +315,13 @@ class InvertedIndex:
             logger.debug(f'Could not find {self._out_dir}')
             return
 
-        for disk in self._out_dir.glob('*.bin'):
-            self._partitions.append(disk)
+        # Partitions are named after their least token. Order them by it, as a build does.
+        partitions = sorted(
+            (disk.stem.removeprefix('partition_'), disk)
+            for disk in self._out_dir.glob('partition_*.bin'))
+
+        self._min_tokens = [min_token for min_token, _ in partitions]
+        self._partitions = [disk for _, disk in partitions]
 
     def build(self):
         """
@@ -232,167 +332,338 @@ class InvertedIndex:
             shutil.rmtree(self._out_dir)
         self._out_dir.mkdir(parents = True, exist_ok = True)
 
-        # Add each page in the root dir.
-        for page in self._root_dir.rglob('*.json'):
-            # This accesses the file on disk which is inefficient bc the tokenizer does that.
-            # We can move this logic to tokenizer which will improve runtime but increase coupling.
-            # Putting it here because we build the index only once
-            if not self.no_duplicate_detection:
-                if self._is_similar(page):
+        pages = list(self._root_dir.rglob('*.json'))
+        process_page = functools.partial(
+            _process_page,
+            detect_duplicates = not self.no_duplicate_detection,
+            use_tokens_cache = self.use_tokens_cache)
+
+        # Simhashing and tokenizing are CPU-bound and independent per page, so spread them over
+        # worker processes. imap keeps the results in page order, so duplicates are decided in
+        # page order and postings are still appended in doc order. Near-duplicates are tokenized
+        # too, but they are rare.
+        with multiprocessing.Pool() as pool:
+            for page, (hashed_doc, token_freqs) in zip(
+                    pages, pool.imap(process_page, pages, chunksize = _TOKENIZE_CHUNKSIZE)):
+                if hashed_doc is not None and self._is_similar(hashed_doc):
                     continue
 
-            self._add_page(page)
+                self._add_page(page, token_freqs)
 
     def flush(self):
         """
         Write the in-memory portion of the index to a partition on disk.
         """
-        disk = self._out_dir / f'partition_{self._partition_count}.bin'
+        # Not named like the final partitions (partition_<least token>), which are written while
+        # these are still being merged.
+        disk = self._out_dir / f'flushed_{self._partition_count}.bin'
         self._partitions.append(disk)
         self._partition_count += 1
 
-        self._flush_idx_data(disk, self._buf)
+        self._flush_idx_data(disk, self._buf, read_once = True) # Clears the buffer.
+
+    def _merge_passes(self, disks: list[Path]) -> list[Path]:
+        """
+        Merge partitions in passes until at most _MAX_MERGE_FAN_IN of them remain, so that the
+        final merge does not open too many partitions at once. Each pass merges runs of consecutive
+        partitions into a new partition, so postings stay in doc order.
+
+        Args:
+            disks: The (sorted) partitions to merge, in the order they were flushed.
+
+        Returns:
+            The remaining partitions, in order.
+        """
+        while len(disks) > _MAX_MERGE_FAN_IN:
+            logger.debug(f'Merging {len(disks)} partitions in runs of {_MAX_MERGE_FAN_IN} for '
+                         f'InvertedIndex {self.name}')
+            merged_disks = []
+            for i in range(0, len(disks), _MAX_MERGE_FAN_IN):
+                run = disks[i:i + _MAX_MERGE_FAN_IN]
+                if len(run) == 1: # Nothing to merge it with.
+                    merged_disks.append(run[0])
+                    continue
+
+                disk = self._out_dir / f'flushed_{self._partition_count}.bin'
+                self._partition_count += 1
+                with open(disk, 'wb') as f:
+                    for token, token_entry_data in self._merge(run): # Deletes the run once merged.
+                        f.write(self._encode_entry(token, token_entry_data))
+                merged_disks.append(disk)
 
-    def _merge(self):
+            disks = merged_disks
+
+        return disks
+
+    def _merge(self, disks: list[Path]) -> Generator[tuple[bytes, bytes], None, None]:
         """
-        Merge all partitions into a single index file using K-way merge algorithm. Maintains
+        Merge partitions into a single stream of entries using K-way merge algorithm. Maintains
         O(1) space complexity relative to total index size on disk and O(N) time complexity
         relative to total number of entries on index (N = K1 + K2 + .. + Kn, Ki ∈ Files being
-        merged.)
-        """
-        # Open each partition file simultaneously.
-        f_streams = [open(p, 'rb') for p in self._partitions]
-        pq = [] # Priority Queue (min heap) to track the least token. We want to maintain sort
-                # in the merged file.
+        merged.) The partitions are deleted once fully merged.
 
-        # First pass of the partition files - init the min heap with their first tokens.
-        for i, stream in enumerate(f_streams):
-            try:
-                token, token_entry = self._next_entry(stream)
-                heapq.heappush(pq, (token, i, token_entry)) # O(log N), N = heap items count.
-            except StopIteration:
-                pass
-
-        last_token = None # Previous token. Used to determine when posting lists should be merged.
-        batch: list[tuple] = [] # Current in-memory merged segment, written in batches.
-
-        while pq: # Iterate until nothing left in token queue.
-            token, idx, token_entry = heapq.heappop(pq) # Get the next (smallest) token entry for
-                                                         # merging. O(log N), N = heap items count.
-            if last_token == token:
-                # Same token in two partitions - merge their postings.
-                # Protobuf's MergeFrom() is O(N) for repeated fields (such as posting list), N =
-                # number of repeated fields.
-                batch[-1][1].df += token_entry.df
-                batch[-1][1].MergeFrom(token_entry)
-            else:
-                # New token - append it to the batch.
-                batch.append((token, token_entry))
-                last_token = token # New token = new latest token.
+        Args:
+            disks: The (sorted) partitions to merge.
 
-            try:
-                # Push the next token and postings to be added from this partition to the min heap.
-                next_token, next_token_entry = self._next_entry(f_streams[idx])
-                heapq.heappush(pq, (next_token, idx, next_token_entry))
-            except StopIteration:
-                pass
-
-            new_batch = []
-            # Write the batch to disk if it exceeds the in-memory postings limit.
-            if len(batch) >= self.postings_flush_count:
-                # Map it to a dict of helper function typing consistency.
-                d: dict[str, TokenEntry] = {}
-                for token, token_entry in batch:
-                    if token == last_token:
-                        new_batch.append((token, token_entry))
-                    else:
-                        d[token] = token_entry
-                batch.clear()
-                batch.extend(new_batch)
-
-                if d:
-                    self._flush_idx_data(self._merged_file, d)
-
-        # Write any residual data to disk (final batch).
-        if batch:
-            d: dict[str, TokenEntry] = {}
-            for token, token_entry in batch:
-                d[token] = token_entry
-            batch.clear()
-            self._flush_idx_data(self._merged_file, d)
+        Returns:
+            Generator of (UTF-8 encoded token, serialized TokenEntry) tuples, in token order.
+        """
+        # Open each partition file simultaneously. Entries are kept serialized, and only parsed
+        # when they need merging. Tokens are kept encoded too: UTF-8 bytes order the same as the
+        # strings they encode, and are written back as is.
+        f_streams = [self._read_serialized_entries(p, decode_tokens = False) for p in disks]
+
+        # heapq.merge streams the (sorted) partitions in token order, keeping the partitions' order
+        # for equal tokens, so each token's postings stay in doc order. Consecutive entries of the
+        # same token (one per partition it appears in) are grouped and merged into one.
+        merged = heapq.merge(*f_streams, key = itemgetter(0))
+
+        for token, group in groupby(merged, key = itemgetter(0)):
+            token_entries_data = [token_entry_data for _, token_entry_data in group]
+            if len(token_entries_data) == 1:
+                # Only in one partition - passed on as is.
+                yield token, token_entries_data[0]
+                continue
+
+            # Same token in several partitions. Serialized repeated fields concatenate into their
+            # merge, so the postings are merged (in order) without being parsed, behind the summed
+            # df.
+            dfs, postings_data = zip(*map(self._split_token_entry, token_entries_data))
+            yield token, b''.join((TokenEntry(df = sum(dfs)).SerializeToString(), *postings_data))
 
         # Close all partition disks.
         for f in f_streams:
             f.close()
 
         # Paritition files no longer needed - they're all merged.
-        for partition in self._partitions:
-            partition.unlink(missing_ok = True)
+        for disk in disks:
+            disk.unlink(missing_ok = True)
 
-        # Index now consists solely of a single merged file.
-        self._partitions = [self._merged_file]
-        self._partition_count = 0
-
-    def _flush_idx_data(self, disk: Path, data: dict[str, TokenEntry]):
+    def _flush_idx_data(self,
+                        disk: Path,
+                        data: dict[str, list[tuple[int, dict[str, int]]]],
+                        read_once: bool = False):
         """
         Flush arbitrary inverted index data to disk.
 
         Args:
             disk: The disk file path to write to.
-            data: Inverted index data in memory.
+            data: Inverted index data in memory: token -> (doc id, tag frequencies) of its postings.
+            read_once: Whether the file is only read once more (i.e. a partition awaiting merge).
+            If so, the OS is told not to keep it cached.
+        """
+        # Entries are assembled in memory and written to disk at once. Each token's entry is
+        # serialized as soon as it is built, so a single message is reused for all of them.
+        buf = bytearray()
+        token_entry = TokenEntry()
+        # Only the tokens are sorted, so no (token, postings) tuple is allocated per entry.
+        for token in sorted(data):
+            postings = data[token]
+            token_entry.Clear()
+            token_entry.df = len(postings)
+
+            # Postings are added in place through add(), rather than built as standalone messages
+            # and copied into the entry.
+            add_posting = token_entry.postings.add
+            for doc_id, tag_freqs in postings:
+                posting = add_posting()
+                posting.doc_id = doc_id
+                # frequency is left unset: it is the sum of the tag frequencies, so storing it
+                # only duplicates them.
+                # Most of a token's tags don't occur in a given page. Zero tag frequencies are left
+                # out of the postings (a missing tag reads as 0), which shrinks them to about a
+                # third.
+                posting.tag_frequencies.update(
+                    {tag: freq for tag, freq in tag_freqs.items() if freq})
+
+            buf += self._encode_entry(token, token_entry.SerializeToString())
+
+        # Guarded, so that the memory stats aren't read on every flush when not debugging.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Flushing {len(buf) / 1024}KB ({len(data)} tokens) from memory to {disk}')
+            logger.debug(f'{psutil.virtual_memory().percent}% virtual memory currently used')
+
+        self._write_entries(disk, buf, read_once)
+
+        data.clear()
+
+    @staticmethod
+    def _write_entries(disk: Path, entries: bytes | bytearray, read_once: bool = False):
         """
-        logger.debug(f'Flushing {sys.getsizeof(data) / 1024}KB from memory to {disk}')
-        logger.debug(f'{psutil.virtual_memory().percent}% virtual memory currently used')
+        Append encoded entries to a disk file.
 
+        Args:
+            disk: The disk file path to write to.
+            entries: The entries, encoded in their on-disk format and in token order.
+            read_once: Whether the file is only read once more (i.e. a partition awaiting merge).
+            If so, the OS is told not to keep it cached.
+        """
         with open(disk, 'ab+') as f:
-            for token, token_entry in sorted(data.items()):
-                # Map to protobuf types and serialize.
-                entry = TokenEntry(df = token_entry.df, postings = token_entry.postings)
-                entry_data = entry.SerializeToString()
-
-                # Write the length of the token. Needed to efficiently stream data token-by-token.
-                # We need to know where one token entry ends and another starts; these are variable.
-                f.write(struct.pack('I', len(token)))
-                # Write the token.
-                f.write(token.encode('utf-8'))
-                # Write the size of the postings.
-                f.write(struct.pack('I', len(entry_data)))
-                # Write the serialized postings.
-                f.write(entry_data)
+            f.write(entries)
 
-        data.clear()
+            if read_once and hasattr(os, 'posix_fadvise'): # Not available on Windows.
+                # Leave the page cache to the pages being read, rather than this file.
+                f.flush()
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    @staticmethod
+    def _encode_entry(token: str | bytes, entry_data: bytes) -> bytes:
+        """
+        Encode a token-postings entry in its on-disk format.
+
+        Args:
+            token: The entry's token, or its UTF-8 encoding.
+            entry_data: The entry's serialized TokenEntry.
+
+        Returns:
+            The encoded entry.
+        """
+        token_data = token.encode('utf-8') if isinstance(token, str) else token
+
+        # The length of the token comes first. Needed to efficiently stream data token-by-token.
+        # We need to know where one token entry ends and another starts; these are variable. Then
+        # the token, the size of the postings, and the serialized postings.
+        return b''.join((
+            _LENGTH.pack(len(token_data)), token_data, _LENGTH.pack(len(entry_data)), entry_data))
 
-    def _partition(self):
+    @staticmethod
+    def _split_token_entry(entry_data: bytes) -> tuple[int, bytes | memoryview]:
         """
-        Partition the merged inverted index file to several smaller files. These partitions are
+        Split a serialized TokenEntry into its df and its serialized postings, without parsing the
+        postings.
+
+        Args:
+            entry_data: The serialized TokenEntry.
+
+        Returns:
+            The entry's df, and its postings serialized as a TokenEntry without a df.
+        """
+        if entry_data[:1] != bytes((_DF_KEY,)):
+            # df is not in front, so the entry has to be parsed to find it.
+            token_entry = TokenEntry.FromString(entry_data)
+            return token_entry.df, TokenEntry(postings = token_entry.postings).SerializeToString()
+
+        # Decode the df varint: 7 bits per byte, least significant first, while the high bit is set.
+        df = shift = 0
+        pos = 1
+        while True:
+            byte = entry_data[pos]
+            pos += 1
+            df |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return df, memoryview(entry_data)[pos:]
+            shift += 7
+
+    def _partition(self, entries: Iterable[tuple[bytes, bytes]]):
+        """
+        Partition the merged inverted index to several smaller files. These partitions are
         lexicographically ordered. Runs in O(N) time relative to the size of the merged index.
+
+        Args:
+            entries: The merged index's (UTF-8 encoded token, serialized TokenEntry) tuples, in
+            token order.
         """
-        merged = self.disks[0]
         self._postings_count = 0
-        with open(merged, 'rb') as f:
-            while True: # Runs until there are no more entries.
-                try:
-                    # Appends tokens to the in-memory buffer while under the partition size
-                    # threshold.
-                    while self._postings_count < self.partition_posting_size:
-                        token, token_entry = self._next_entry(f)
-                        self._buf[token] = token_entry
-                        self._postings_count += len(token_entry.postings)
-                except StopIteration:
-                    # No more entries.
-                    break
-                finally:
-                    # Write in-memory partition to disk.
-                    min_token = sorted(self._buf.keys())[0]
-                    name = f'partition_{min_token}.bin'
-                    path = self._out_dir / name
+        f = None # Partition currently being written.
+        offset = 0 # Size of the partition currently being written.
+        term_offsets: dict[str, tuple[int, int]] = {} # Its token -> (entry offset, entry length).
+
+        # The merged index is already sorted, so entries are copied straight to the partitions in
+        # order (still serialized), rather than being buffered and sorted again.
+        for token_data, token_entry_data in entries:
+            token = token_data.decode('utf-8')
+            if f is None:
+                # Start a new partition. Its first token is its least.
+                path = self._out_dir / f'partition_{token}.bin'
+                f = open(path, 'wb')
+                self._partitions.append(path)
+                self._min_tokens.append(token)
+
+            encoded = self._encode_entry(token_data, token_entry_data)
+            f.write(encoded)
+            offset += len(encoded)
+            # The token entry is last in the encoded entry.
+            term_offsets[token] = (offset - len(token_entry_data), len(token_entry_data))
+
+            # A token has a posting per document it appears in.
+            self._postings_count += self._split_token_entry(token_entry_data)[0]
+
+            # Move on to a new partition once the partition size threshold is reached.
+            if self._postings_count >= self.partition_posting_size:
+                f.close()
+                self._write_term_offsets(path, term_offsets)
+                f = None
+                offset = 0
+                term_offsets = {}
+                self._postings_count = 0
+
+        if f:
+            f.close()
+            self._write_term_offsets(path, term_offsets)
+
+    @staticmethod
+    def _term_offsets_file(partition: Path) -> Path:
+        """
+        Get the file holding the term offsets of a partition, alongside the partition itself.
+
+        Args:
+            partition: Path to the partition.
+
+        Returns:
+            Path to the partition's term offsets.
+        """
+        return partition.with_suffix('.json')
+
+    def _write_term_offsets(self, partition: Path, term_offsets: dict[str, tuple[int, int]]):
+        """
+        Persist the term offsets of a partition, so that lookups can seek straight to a token's
+        entry rather than scanning the partition for it.
+
+        Args:
+            partition: Path to the partition.
+            term_offsets: Dict of the partition's tokens to the (offset, length) of their token
+            entries within it.
+        """
+        with open(self._term_offsets_file(partition), 'wb') as f:
+            f.write(orjson.dumps(term_offsets))
+
+    def _get_term_offsets(self, partition: Path) -> dict[str, list[int]] | None:
+        """
+        Get the term offsets of a partition, loading them from disk unless they were recently
+        used. At most _TERM_OFFSETS_CACHE_SIZE partitions' term offsets are kept in memory.
+
+        Args:
+            partition: Path to the partition.
+
+        Returns:
+            Same as _load_term_offsets.
+        """
+        if partition in self._term_offsets:
+            self._term_offsets.move_to_end(partition)
+            return self._term_offsets[partition]
+
+        term_offsets = self._term_offsets[partition] = self._load_term_offsets(partition)
+        if len(self._term_offsets) > _TERM_OFFSETS_CACHE_SIZE:
+            self._term_offsets.popitem(last = False) # Least recently used.
 
-                    self._flush_idx_data(path, self._buf)
-                    self._partitions.append(path)
-                    self._postings_count = 0
+        return term_offsets
 
-        merged.unlink()
-        self._partitions.remove(merged)
+    def _load_term_offsets(self, partition: Path) -> dict[str, list[int]] | None:
+        """
+        Load the term offsets of a partition from disk.
+
+        Args:
+            partition: Path to the partition.
+
+        Returns:
+            Dict of the partition's tokens to the (offset, length) of their token entries within
+            it, or None if the partition has no term offsets.
+        """
+        try:
+            with open(self._term_offsets_file(partition), 'rb') as f:
+                return orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return None
 
     def _get_partition_file(self, token: str) -> Path:
         """
@@ -406,101 +677,181 @@ class InvertedIndex:
         Returns:
             Path to partition file.
         """
-        index = bisect.bisect_left(self._token_ranges, token)
-        return self.disks[index - 1] if index else self.disks[0]
+        # The last partition whose least token is not past the token.
+        index = bisect.bisect_right(self._min_tokens, token) - 1
+        return self.disks[max(index, 0)]
 
-    def _iter_partition(self, token: str) -> Generator[tuple[str, list], None, None]:
+    def _read_entries(self, disk: Path) -> Generator[tuple[str, TokenEntry], None, None]:
         """
-        Iterates over all token-posting items in specified token's partition.
+        Iterates over the token-postings entries of a file on disk, in order.
 
         Args:
-            token: The token whose partition to iterate over.
+            disk: Path to the index file.
 
         Returns:
-            Generator of token-posting tuples.
+            Generator of (token, postings) tuples.
         """
-        partition = self._get_partition_file(token)
-        with open(partition, 'rb') as f:
-            while True:
-                try:
-                    yield self._next_entry(f)
-                except StopIteration:
-                    break
+        for token, token_entry_data in self._read_serialized_entries(disk):
+            # Deserialize postings to protobuf types.
+            token_entry = TokenEntry()
+            try:
+                token_entry.ParseFromString(token_entry_data)
+            except DecodeError:
+                # If something goes wrong, can't reliably parse the file further.
+                logger.warning(f'Could not decode the postings of {token} in {disk}')
+                return
 
-    def _next_entry(self, f: BinaryIO) -> tuple[str, TokenEntry]:
+            yield token, token_entry
+
+    @staticmethod
+    def _map_file(disk: Path | str) -> mmap.mmap | None:
         """
-        Get the next token-postings entry in an opened binary file.
+        Memory map a file on disk for reading. The file itself is closed right away: the map keeps
+        its own (duplicated) descriptor, so holding both would take two descriptors per file (e.g.
+        per partition being merged).
 
         Args:
-            f: File openend in binary read mode.
+            disk: Path to the file.
 
         Returns:
-            Tuple entry of (token, postings) for the next token-postings entry in the file.
+            Read-only map of the file, or None if the file is empty (empty files can't be mapped).
         """
-        length_bytes = f.read(4) # Encoded length of the token.
-        if not length_bytes: # Might not be any more tokens.
-            raise StopIteration
+        with open(disk, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
 
-        try:
-            token_length = struct.unpack('I', length_bytes)[0] # Decode token length.
-            token = f.read(token_length).decode('utf-8') # Decode token.
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
 
-            token_entry_length = struct.unpack('I', f.read(4))[0] # Decode posting list length.
-            token_entry_data = f.read(token_entry_length) # Decode posting list.
+    def _read_serialized_entries(self, disk: Path, decode_tokens: bool = True
+                                 ) -> Generator[tuple[str | bytes, bytes], None, None]:
+        """
+        Iterates over the entries of a file on disk, in order, without deserializing their
+        postings. The file is memory mapped and read by offset, rather than through several read()
+        calls per entry.
 
-            # Deserialize postings to protobuf types.
-            token_entry = TokenEntry()
-            token_entry.ParseFromString(token_entry_data)
+        Args:
+            disk: Path to the index file.
+            decode_tokens: Whether to decode the tokens. If not, they are given UTF-8 encoded.
+
+        Returns:
+            Generator of (token, serialized TokenEntry) tuples.
+        """
+        mm = self._map_file(disk)
+        if mm is None:
+            return
+
+        with mm:
+            if hasattr(mm, 'madvise'): # Not available on Windows.
+                # Read front to back, so the OS can read ahead aggressively.
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+
+            pos = 0
+            while pos < len(mm): # Runs until there are no more tokens.
+                try:
+                    token_length = _LENGTH.unpack_from(mm, pos)[0] # Decode token length.
+                    pos += _LENGTH.size
+                    token = mm[pos:pos + token_length]
+                    if decode_tokens:
+                        token = token.decode('utf-8') # Decode token.
+                    pos += token_length
+
+                    # Decode posting list length.
+                    token_entry_length = _LENGTH.unpack_from(mm, pos)[0]
+                    pos += _LENGTH.size
+
+                    token_entry_data = mm[pos:pos + token_entry_length]
+                    pos += token_entry_length
+                except (struct.error, UnicodeDecodeError):
+                    # If something goes wrong, can't reliably parse the file further.
+                    logger.warning(f'Could not decode the entry at byte {pos} of {disk}')
+                    return
 
-            return token, token_entry
-        except:
-            # If something goes wrong, can't reliably parse the file further.
-            raise StopIteration
+                if pos > len(mm):
+                    logger.warning(f'Truncated entry for {token} at the end of {disk}')
+                    return
 
-    def _add_page(self, page: Path):
+                yield token, token_entry_data
+
+    def _add_page(self, page: Path, token_freqs: dict[str, dict[str, int]]):
         """
         Add a page to the index.
 
         Args:
             page: Path to json response file.
+            token_freqs: The page's tokens, mapped to their tag frequencies.
         """
         self._page_count += 1
         doc_id = self._mapper.get_id(str(page))
-        for token, tag_freqs in tokenize_JSON_file_with_tags(page, _WEIGHTED_TAGS).items():
-            self._buf[token].postings.append(Posting(
-                doc_id = doc_id,
-                frequency = sum(tag_freqs.values()), # Kept for now for compatibility.
-                tag_frequencies = tag_freqs))
-            self._buf[token].df += 1
-            self._postings_count += 1
-
-            # Flush to disk if in-memory index grows too large.
-            if self._postings_count >= self.postings_flush_count:
-                self._postings_count = 0
-                self.flush()
-                self._buf.clear()
-
-    def _is_similar(self, page: Path) -> bool:
-        """
-        Returns True if provided content is similar to another document.
+        buf = self._buf
+        for token, tag_freqs in token_freqs.items():
+            buf[token].append((doc_id, tag_freqs))
+        self._postings_count += len(token_freqs) # A posting per token of the page.
+
+        # Flush to disk if in-memory index grows too large. Checked once per page rather than per
+        # posting, so the flush count may be exceeded by up to a page's postings.
+        if self._postings_count >= self.postings_flush_count:
+            self._postings_count = 0
+            self.flush()
+        # Postings vary in size (e.g. by their tag frequencies), so also flush early if the system
+        # is running low on memory. Checked once per page, which is cheap next to tokenizing it.
+        elif (self._postings_count >= self.postings_flush_count * _MEMORY_FLUSH_MIN_FRACTION
+                and psutil.virtual_memory().percent >= _MEMORY_FLUSH_PERCENT):
+            logger.debug(f'Flushing {self._postings_count} postings early due to memory pressure')
+            self._postings_count = 0
+            self.flush()
+
+    def _is_similar(self, hashed_doc: bytes) -> bool:
+        """
+        Returns True if provided content is similar to another document. Otherwise, records it as
+        explored.
     
         Args:
-            page: Path to the json of a document
+            hashed_doc: simhash of a document's content
     
         Returns:
             bool: if the document is similar to another one
         """
-        with open(page, 'r') as file:
-            html = json.load(file)['content']
-            hashed_doc = simhash(html)
-        
-            if hashed_doc in self._simhashes:
+        # Only documents sharing at least one band with this one can be similar enough, so compare
+        # against those rather than every explored document.
+        band_size = len(hashed_doc) // _SIMHASH_BANDS
+        bands = [hashed_doc[i * band_size:(i + 1) * band_size] for i in range(_SIMHASH_BANDS)]
+
+        candidates = set()
+        for band, buckets in zip(bands, self._simhash_bands):
+            candidates.update(buckets.get(band, ()))
+
+        if hashed_doc in candidates:
+            return True
+
+        for explored_hash in candidates:
+            sim = calculate_similarity_score(hashed_doc, explored_hash)
+            if sim >= _SIMILARITY_THRESHOLD:
                 return True
-        
-            # TODO: with a big index, we may not be able to hold every single simhash in memory
-            for explored_hash in self._simhashes:
-                sim = calculate_similarity_score(hashed_doc, explored_hash)
-                if sim >= _SIMILARITY_THRESHOLD:
-                    return True
-    
+
+        for band, buckets in zip(bands, self._simhash_bands):
+            buckets.setdefault(band, []).append(hashed_doc)
+
         return False
+
+def _process_page(page: Path,
+                  detect_duplicates: bool,
+                  use_tokens_cache: bool) -> tuple[bytes | None, dict[str, dict[str, int]]]:
+    """
+    Simhash a page (for duplicate detection) and tokenize it with tag frequencies. Module-level so
+    that it can be sent to worker processes.
+
+    Args:
+        page: Path to json response file.
+        detect_duplicates: Whether to simhash the page.
+        use_tokens_cache: Whether to use the tokens cache.
+
+    Returns:
+        Tuple of the page's simhash (None if not detecting duplicates), and dict of its tokens to
+        their tag frequencies.
+    """
+    # Read once, for both the simhash and the tokenizer.
+    content = get_content_from_JSON(page)
+    hashed_doc = simhash(content) if detect_duplicates else None
+
+    return hashed_doc, tokenize_JSON_file_with_tags(
+        page, _WEIGHTED_TAGS, content = content, use_cache = use_tokens_cache)
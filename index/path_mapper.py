@@ -3,11 +3,9 @@ import os
 import json
 import re
 
-from index.defs import APP_DATA_DIR
+from index.defs import app_data_dir
 
 
-_MAPPER_DIR = APP_DATA_DIR / 'mappers'
-
 logger = logging.getLogger(__name__)
 
 class PathMapper:
@@ -26,7 +24,7 @@ class PathMapper:
         self.root_path = root_path
 
         name = re.sub(r'[<>:"/\\|?*]', '_', self.root_path)
-        self._mapper_disk_path = _MAPPER_DIR / f'{name}.json'
+        self._mapper_disk_path = app_data_dir() / 'mappers' / f'{name}.json'
 
         self.path_to_id, self.url_to_id = ({}, {})
 
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by the protocol buffer compiler.  DO NOT EDIT!
+# source: posting.proto
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
+from google.protobuf import descriptor as _descriptor
+from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import symbol_database as _symbol_database
+# @@protoc_insertion_point(imports)
+
+_sym_db = _symbol_database.Default()
+
+
+
+
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rposting.proto\"\x9a\x01\n\x07Posting\x12\x0e\n\x06\x64oc_id\x18\x01 \x01(\r\x12\x11\n\tfrequency\x18\x02 \x01(\r\x12\x35\n\x0ftag_frequencies\x18\x03 \x03(\x0b\x32\x1c.Posting.TagFrequenciesEntry\x1a\x35\n\x13TagFrequenciesEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\r:\x02\x38\x01\")\n\x0bPostingList\x12\x1a\n\x08postings\x18\x01 \x03(\x0b\x32\x08.Posting\"4\n\nTokenEntry\x12\n\n\x02\x64\x66\x18\x01 \x01(\r\x12\x1a\n\x08postings\x18\x02 \x03(\x0b\x32\x08.Postingb\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'posting_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _POSTING_TAGFREQUENCIESENTRY._options = None
+  _POSTING_TAGFREQUENCIESENTRY._serialized_options = b'8\001'
+  _POSTING._serialized_start=18
+  _POSTING._serialized_end=172
+  _POSTING_TAGFREQUENCIESENTRY._serialized_start=119
+  _POSTING_TAGFREQUENCIESENTRY._serialized_end=172
+  _POSTINGLIST._serialized_start=174
+  _POSTINGLIST._serialized_end=215
+  _TOKENENTRY._serialized_start=217
+  _TOKENENTRY._serialized_end=269
+# @@protoc_insertion_point(module_scope)
@@ -1,5 +1,7 @@
 from collections import defaultdict
+from functools import lru_cache
 from pathlib import Path
+import heapq
 import math
 import logging
 import json
@@ -7,21 +9,22 @@ import re
 
 from nltk.stem import PorterStemmer
 from spellchecker import SpellChecker
-from textblob import Word
 import time
 
-from index.inverted_index import InvertedIndex, Posting, result
+from index.inverted_index import InvertedIndex, Posting
 from index.path_mapper import PathMapper
-from index.JSONtokenizer import compute_word_frequencies, tokenize, get_soup_from_JSON
-from index.defs import APP_DATA_DIR
+from index.JSONtokenizer import compute_word_frequencies, tokenize_query, tokenize_JSON_file, lemmatize_token
+from index.defs import app_data_dir
 
-_SEARCHER_DIR = APP_DATA_DIR / 'searcher'
 logger = logging.getLogger(__name__)
 
 HTML_TAGS_WEIGHTS = {
     "h1": 0.2, "h2": 0.15, "h3": 0.1, "title": 0.4, "b": 0.075, "strong": 0.055, "other": 0.02
 }
 
+# Number of top tf-idf documents re-ranked by cosine similarity. Lower-ranked documents are pruned.
+_RERANK_CANDIDATES = 50
+
 class Searcher:
     """
     Wrapper around an inverted index used to retrieve relevant documents given search results.
@@ -35,23 +38,22 @@ class Searcher:
         self._use_spellcheck = use_spellcheck
         self.path_mapper = self._index._mapper
         self.spellchecker = SpellChecker()
+        # Spelling correction searches edit-distance candidates, so remember corrected tokens.
+        self._correction = lru_cache(maxsize = 8192)(self.spellchecker.correction)
         self._document_vectors = dict()
 
         name = re.sub(r'[<>:"/\\|?*]', '_', source_dir_path)
-        self._searcher_disk_path = _SEARCHER_DIR / f'{name}.json'
+        self._searcher_disk_path = app_data_dir() / 'searcher' / f'{name}.json'
 
         if not kwargs['load_existing'] or not self._load():
             logger.debug(f'Building document_vectors from scratch')
 
             for doc_id, path in self.path_mapper.id_to_path.items():
-                soup = get_soup_from_JSON(path)
-                self._document_vectors[str(doc_id)] = compute_word_frequencies(tokenize(soup.get_text(' ')))
+                tokens = tokenize_JSON_file(path, lemmatize = False)
+                self._document_vectors[str(doc_id)] = compute_word_frequencies(tokens)
 
             self._save()
 
-        Word("octopi").lemmatize() # used to load data from textblob library so first 
-                                       # query processing time is the same as the others
-
     def _save(self):
         """
         Saves the document vectors to disk, so it does not need to be recalculated for later runs.
@@ -130,10 +132,10 @@ class Searcher:
             corrected_tokens = set()
             for token in tokens:
                 if not self._has_strange_pattern(token):
-                    corrected_tokens.add(self.spellchecker.correction(token) or token)
+                    corrected_tokens.add(self._correction(token) or token)
 
         # Lemmatize tokens
-        lemmatized_tokens = {Word(token).lemmatize() for token in corrected_tokens}
+        lemmatized_tokens = {lemmatize_token(token) for token in corrected_tokens}
 
         # Combine all variations
         expanded_tokens = lemmatized_tokens.union(corrected_tokens)
@@ -152,7 +154,7 @@ class Searcher:
             A number representing the cosine of the angle between the 2 strings in vector space.
         """
         # calculate vectors for both strings (vector = word frequencies)
-        query_vector = compute_word_frequencies(tokenize(query))
+        query_vector = compute_word_frequencies(tokenize_query(query))
         document_vector = self._document_vectors[doc_id]
 
         # calculate cosine
@@ -188,7 +190,10 @@ class Searcher:
                 idf = 0 if token_df == 0 or self._index.page_count == 0 else math.log(self._index.page_count / token_df)
 
                 tfidf = 0
-                for tag, frequency in posting.tag_frequencies.items():
+                # Tags that do not occur in the page are left out of its posting.
+                tag_frequencies = posting.tag_frequencies
+                for tag in HTML_TAGS_WEIGHTS:
+                    frequency = tag_frequencies.get(tag, 0)
                     log = 0 if frequency == 0 else math.log(frequency)
                     tfidf += HTML_TAGS_WEIGHTS[tag] * (1 + log) * idf
 
@@ -201,12 +206,13 @@ class Searcher:
         # End timer after retrieval -- exclude ranking.
         end_time = time.perf_counter()
 
-        # sort documents by relevance score
-        sorted_docs = sorted(filtered_docs.items(), key = lambda x : x[1], reverse = True)
+        # get the most relevant documents. Only these are re-ranked, so there is no need to sort
+        # every matching document - O(N log K) rather than O(N log N).
+        top_docs = heapq.nlargest(_RERANK_CANDIDATES, filtered_docs.items(), key = lambda x : x[1])
 
         # using cosign similarity on sorted items
         cosign_scores: dict[int, int] = defaultdict(int)
-        for document_id, _ in sorted_docs[:50]:
+        for document_id, _ in top_docs:
             cosign_scores[document_id] = self._cosine_similarity(query, str(document_id))
 
         # resorting
@@ -2,7 +2,7 @@ import boto3
 import zipfile
 import io
 
-from index.defs import APP_DATA_DIR
+from index.defs import app_data_dir
 
 
 # Script that runs in the deployed environment to retrieve the developer pages.
@@ -37,4 +37,4 @@ def download_and_unzip_prebuilt_index():
     Downloads our prebuilt index from S3 and extracts it. Saves time as the index takes a while
     to build.
     """
-    download_and_unzip('prebuilt.zip', str(APP_DATA_DIR))
+    download_and_unzip('prebuilt.zip', str(app_data_dir()))